@@ -1,3 +1,7 @@
+import numpy as np
+
+from functools import lru_cache
+
 from solution import *
 
 test_multiply = True
@@ -6,25 +10,27 @@ test_sampling = True
 test_confound = True
 test_mediate = True
 
-#  E,B,S,w,G example
-E, B, S, G, W = Variable('E', ['e', '-e']), Variable('B', ['b', '-b']), Variable('S', ['s', '-s']), Variable('G', ['g',
-                                                                                                                   '-g']), Variable(
-    'W', ['w', '-w'])
-FE, FB, FS, FG, FW = Factor('P(E)', [E]), Factor('P(B)', [B]), Factor('P(S|E,B)', [S, E, B]), Factor('P(G|S)',
-                                                                                                     [G, S]), Factor(
-    'P(W|S)', [W, S])
+#  E,B,S,w,G example, built lazily on first use and then reused
+@lru_cache(maxsize=1)
+def _build_example_bn():
+    E, B, S, G, W = Variable('E', ['e', '-e']), Variable('B', ['b', '-b']), Variable('S', ['s', '-s']), Variable(
+        'G', ['g', '-g']), Variable('W', ['w', '-w'])
+    FE, FB, FS, FG, FW = Factor('P(E)', [E]), Factor('P(B)', [B]), Factor('P(S|E,B)', [S, E, B]), Factor(
+        'P(G|S)', [G, S]), Factor('P(W|S)', [W, S])
 
-FE.add_values([['e', 0.1], ['-e', 0.9]])
-FB.add_values([['b', 0.1], ['-b', 0.9]])
-FS.add_values([['s', 'e', 'b', .9], ['s', 'e', '-b', .2], ['s', '-e', 'b', .8], ['s', '-e', '-b', 0],
-               ['-s', 'e', 'b', .1], ['-s', 'e', '-b', .8], ['-s', '-e', 'b', .2], ['-s', '-e', '-b', 1]])
-FG.add_values([['g', 's', 0.5], ['g', '-s', 0], ['-g', 's', 0.5], ['-g', '-s', 1]])
-FW.add_values([['w', 's', 0.8], ['w', '-s', .2], ['-w', 's', 0.2], ['-w', '-s', 0.8]])
+    FE.add_values([['e', 0.1], ['-e', 0.9]])
+    FB.add_values([['b', 0.1], ['-b', 0.9]])
+    FS.add_values([['s', 'e', 'b', .9], ['s', 'e', '-b', .2], ['s', '-e', 'b', .8], ['s', '-e', '-b', 0],
+                   ['-s', 'e', 'b', .1], ['-s', 'e', '-b', .8], ['-s', '-e', 'b', .2], ['-s', '-e', '-b', 1]])
+    FG.add_values([['g', 's', 0.5], ['g', '-s', 0], ['-g', 's', 0.5], ['-g', '-s', 1]])
+    FW.add_values([['w', 's', 0.8], ['w', '-s', .2], ['-w', 's', 0.2], ['-w', '-s', 0.8]])
 
-ExampleBN = BN('ExampleBN', [E, B, S, G, W], [FE, FB, FS, FG, FW])
+    ExampleBN = BN('ExampleBN', [E, B, S, G, W], [FE, FB, FS, FG, FW])
+    return E, B, S, G, W, FE, FB, FS, FG, FW, ExampleBN
 
 
 def test_multiply_fun():
+    E, B, S, G, W, FE, FB, FS, FG, FW, ExampleBN = _build_example_bn()
     print("\nMultiply Factors Test ... ", end='')
     factor = multiply_factors([FB, FE])
     tests = []
@@ -34,14 +40,11 @@ def test_multiply_fun():
         print("failed.")
         return
 
+    # multiply_factors orders its scope by variable name, so B comes first
     for e_val in E.domain():
         for b_val in B.domain():
-            try:
-                value = factor.get_value([e_val, b_val])
-                values.append(value)
-            except ValueError:
-                value = factor.get_value([b_val, e_val])
-                values.append(value)
+            value = factor.get_value([b_val, e_val])
+            values.append(value)
             tests.append(value == FE.get_value([e_val]) * FB.get_value([b_val]))
     if all(tests):
         print("passed.")
@@ -50,19 +53,19 @@ def test_multiply_fun():
     print('P(e,b) = {} P(-e,b) = {} P(e,-b) = {} P(-e,-b) = {}'.format(values[0], values[1], values[2], values[3]))
 
 def test_ve_fun():
+    E, B, S, G, W, FE, FB, FS, FG, FW, ExampleBN = _build_example_bn()
+    VE.clear_cache()
     print("\nVE Tests .... ")
     print("Test 1 ....", end='')
-    S.set_evidence('-s')
-    W.set_evidence('w')
-    probs3 = VE(ExampleBN, G, [S, W])
-    S.set_evidence('-s')
-    W.set_evidence('-w')
-    probs4 = VE(ExampleBN, G, [S, W])
+    cond = VE_batch(ExampleBN, G, [S, W])
 
-    if (probs4 == None or probs3 == None ):
+    if (cond is None):
         print("failed.")
         return
 
+    probs3 = cond[:, S.value_index('-s'), W.value_index('w')]
+    probs4 = cond[:, S.value_index('-s'), W.value_index('-w')]
+
     if probs3[0] == 0.0 and probs3[1] == 1.0 and probs4[0] == 0.0 and probs4[1] == 1.0:
         print("passed.")
     else:
@@ -70,21 +73,20 @@ def test_ve_fun():
     print('P(g|-s,w) = {} P(-g|-s,w) = {} P(g|-s,-w) = {} P(-g|-s,-w) = {}'.format(probs3[0], probs3[1], probs4[0],
                                                                                    probs4[1]))
     print("Test 2 ....", end='')
-    W.set_evidence('w')
-    probs1 = VE(ExampleBN, G, [W])
-    W.set_evidence('-w')
-    probs2 = VE(ExampleBN, G, [W])
-    if abs(probs1[0] - 0.15265998457979954) < 0.0001 and abs(probs1[1] - 0.8473400154202004) < 0.0001 and abs(
-            probs2[0] - 0.01336753983256819) < 0.0001 and abs(probs2[1] - 0.9866324601674318) < 0.0001:
+    cond = VE_batch(ExampleBN, G, [W])
+    probs1 = cond[:, W.value_index('w')]
+    probs2 = cond[:, W.value_index('-w')]
+    expected1 = np.array([0.15265998457979954, 0.8473400154202004])
+    expected2 = np.array([0.01336753983256819, 0.9866324601674318])
+    if np.allclose(probs1, expected1, atol=0.0001) and np.allclose(probs2, expected2, atol=0.0001):
         print("passed.")
     else:
         print("failed.")
     print('P(g|w) = {} P(-g|w) = {} P(g|-w) = {} P(-g|-w) = {}'.format(probs1[0], probs1[1], probs2[0], probs2[1]))
 
 
-def test_sample_fun():
-
-    model = CausalModelMediator()
+def test_sample_fun(model):
+    VE.clear_cache()
 
     if (model == None):
         print("failed.")
@@ -99,7 +101,7 @@ def test_sample_fun():
     Variables[0].set_evidence("Italy")
 
     probsEstimated1 = SampleBN(model, Variables[2], [Variables[0]])
-    probsExact = VE(model, Variables[2], [Variables[0]])
+    probsExact = VE(model, Variables[2], {Variables[0]: "Italy"})
     probsEstimated2 = SampleBN(model, Variables[2], [Variables[0]])
 
     if abs(probsEstimated1[0] - probsExact[0]) < 0.1 and abs(probsEstimated1[1] - probsExact[1]) < 0.1:
@@ -121,9 +123,23 @@ def test_sample_fun():
 
 
 
-def test_confound_fun():
-    model = CausalModelConfounder()
+def test_sample_root_fun():
+    # regression test: the example net's roots E and B are NOT evidence
+    # here, so the sampler must draw a fresh value per particle for them
+    E, B, S, G, W, FE, FB, FS, FG, FW, ExampleBN = _build_example_bn()
+    VE.clear_cache()
+
+    W.set_evidence('w')
+    probsEstimated = SampleBN(ExampleBN, G, [W])
+    probsExact = VE(ExampleBN, G, [W])
 
+    if abs(probsEstimated[0] - probsExact[0]) < 0.1 and abs(probsEstimated[1] - probsExact[1]) < 0.1:
+        print("Passed non-evidence-root test of sampling.")
+    else:
+        print("Failed non-evidence-root test of sampling.")
+
+
+def test_confound_fun(model):
     if (model == None):
         print("failed.")
         return
@@ -137,31 +153,27 @@ def test_confound_fun():
 
     ages = ['0-9', '10-19', '20-29', '30-39', '40-49', '50-59', '60-69', '70-79', '80']
 
-    for f in Factors:
-
-        if (len(f.get_scope()) == 2):
-            if (abs(f.get_value(['Italy', '70-79']) - 0.89) >= 0.01):
-                print("Failed test of confounding model, P(Italy|Age=70-79) is not 0.89.")
-                return False
-            if (abs(f.get_value(['China', '10-19']) - 0.15) >= 0.01):
-                print("Failed test of confounding model, P(China|Age=10-19) is not 0.15.")
-                return False
-            if (abs(f.get_value(['Italy','70-79']) + f.get_value(['China','70-79']) - 1.0) >= 0.001):
-                print("Failed test of confounding model, P(Italy|Age=70-79) + P(China|Age=70-79) is not 1.0.")
-                return False
-
-        if (len(f.get_scope()) == 1):
-            if len(f.get_values()) != len(ages): #prior on ages
-                print("Failed test of confounding model.")
-                return False
+    for f in model.factors_by_arity(2):
+        actual = np.array([f.get_value(['Italy', '70-79']), f.get_value(['China', '10-19'])])
+        if not np.allclose(actual, [0.89, 0.15], atol=0.01):
+            print("Failed test of confounding model, P(Italy|Age=70-79) is not 0.89 or P(China|Age=10-19) is not 0.15.")
+            return False
+        # one reduction over the country axis checks every age at once
+        col_sums = np.asarray(f.get_values()).sum(axis=0)
+        if not np.all(np.abs(col_sums - 1.0) < 0.001):
+            print("Failed test of confounding model, P(Italy|Age) + P(China|Age) is not 1.0.")
+            return False
+
+    for f in model.factors_by_arity(1):
+        if len(f.get_values()) != len(ages): #prior on ages
+            print("Failed test of confounding model.")
+            return False
 
     print("Passed test of confounding model.")
     return True
 
 
-def test_mediate_fun():
-    model = CausalModelMediator()
-
+def test_mediate_fun(model):
     if (model == None):
         print("failed.")
         return
@@ -173,30 +185,34 @@ def test_mediate_fun():
         print("failed.")
         return
 
-    for f in Factors:
-        if (len(f.get_scope()) == 2):
-            if (abs(f.get_value(['70-79', 'Italy']) - 0.14) >= 0.01):
-                print("Failed test of mediating model, P(Age=70-79|Italy) is not 0.14.")
-                return False
-            if (abs(f.get_value(['10-19', 'China']) - 0.01) >= 0.01):
-                print("Failed test of mediating model, P(Age=10-19|China) is not 0.01.")
-                return False
-            if (abs(f.get_value(['70-79', 'Italy']) + f.get_value(['70-79','China']) - 1.0) <= 0.001):
-                print("Failed test of confounding model, P(Age=70-79|Italy) + P(Age=70-79|China) is 1.0 but should not be.")
-                return False
+    for f in model.factors_by_arity(2):
+        if (abs(f.get_value(['70-79', 'Italy']) - 0.14) >= 0.01):
+            print("Failed test of mediating model, P(Age=70-79|Italy) is not 0.14.")
+            return False
+        if (abs(f.get_value(['10-19', 'China']) - 0.01) >= 0.01):
+            print("Failed test of mediating model, P(Age=10-19|China) is not 0.01.")
+            return False
+        if (abs(f.get_value(['70-79', 'Italy']) + f.get_value(['70-79','China']) - 1.0) <= 0.001):
+            print("Failed test of confounding model, P(Age=70-79|Italy) + P(Age=70-79|China) is 1.0 but should not be.")
+            return False
 
     print("Passed test of mediating model.")
     return True
 
 
 if __name__ == '__main__':
+    # build each causal model once and share it across the tests
+    mediator = CausalModelMediator() if (test_sampling or test_mediate) else None
+    confounder = CausalModelConfounder() if test_confound else None
+
     if test_multiply:
         test_multiply_fun()
     if test_ve:
         test_ve_fun()
     if test_sampling:
-        test_sample_fun()
+        test_sample_fun(mediator)
+        test_sample_root_fun()
     if test_confound:
-        test_confound_fun()
+        test_confound_fun(confounder)
     if test_mediate:
-        test_mediate_fun()
+        test_mediate_fun(mediator)
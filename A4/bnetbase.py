@@ -44,16 +44,35 @@
     multiply_factors, restrict_factor, sum_out_variable, normalize
     '''
 
+import itertools
+from functools import lru_cache
+
+import numpy as np
+
+# Set True to store factor tables in float32. CPT entries have only a
+# couple of digits of precision, so this halves table memory traffic;
+# leave False for full float64 tables.
+USE_FP32 = False
+
+
+def factor_dtype():
+    '''dtype used for factor tables, controlled by USE_FP32'''
+    return np.float32 if USE_FP32 else np.float64
+
 
 class Variable:
     '''Class for defining Bayes Net variables. '''
 
+    __slots__ = ('name', 'dom', '_dom_tuple', '_idx', 'evidence_index', 'assignment_index')
+
     def __init__(self, name, domain=[]):
         '''Create a variable object, specifying its name (a
         string). Optionally specify the initial domain.
         '''
         self.name = name  # text name for variable
         self.dom = list(domain)  # Make a copy of passed domain
+        self._dom_tuple = tuple(self.dom)  # shared immutable copy handed out by domain()
+        self._idx = {v: i for i, v in enumerate(self.dom)}  # value -> domain index
         self.evidence_index = -1  # evidence value (stored as index into self.dom)
         self.assignment_index = -1  # For use by factors. We can assign variables values
         # and these assigned values can be used by factors
@@ -63,46 +82,45 @@ class Variable:
         self.assignment_index = -1  # For use by factors. We can assign variables values
 
     def reset_evidence(self):
-        self.reset_evidence = -1  # For use by factors. We can assign variables values
+        self.evidence_index = -1  # clear the stored evidence value
 
     def add_domain_values(self, values):
         '''Add domain values to the domain. values should be a list.'''
-        for val in values: self.dom.append(val)
+        for val in values:
+            self._idx[val] = len(self.dom)
+            self.dom.append(val)
+        self._dom_tuple = tuple(self.dom)
 
     def value_index(self, value):
         '''Domain values need not be numbers, so return the index
            in the domain list of a variable value'''
-        return self.dom.index(value)
+        try:
+            return self._idx[value]
+        except KeyError:
+            raise ValueError("{} is not in the domain of {}".format(value, self.name))
 
     def domain_size(self):
         '''Return the size of the domain'''
         return (len(self.dom))
 
     def domain(self):
-        '''return the variable domain'''
-        return (list(self.dom))
+        '''return the variable domain (a read-only tuple; call list() on
+           it if you need a mutable copy)'''
+        return self._dom_tuple
 
     def set_evidence(self, val):
         '''set this variable's value when it operates as evidence'''
         self.evidence_index = self.value_index(val)
 
     def get_evidence(self):
-        #print(f"evidence index {self.evidence_index}")
-        if self.evidence_index >= 0:
-            return (self.dom[self.evidence_index])
-        else:
-            return None
+        return self.dom[self.evidence_index] if self.evidence_index >= 0 else None
 
     def set_assignment(self, val):
         '''Set this variable's assignment value for factor lookups'''
         self.assignment_index = self.value_index(val)
 
     def get_assignment(self):
-        #print(f"assignment index {self.assignment_index}")
-        if self.assignment_index >= 0:
-            return (self.dom[self.assignment_index])
-        else:
-            return None
+        return self.dom[self.assignment_index] if self.assignment_index >= 0 else None
 
     ##These routines are special low-level routines used directly by the
     ##factor objects
@@ -142,22 +160,30 @@ class Factor:
     like [[0.25]] to set the factor's single value. The get_value
     functions will still work.  E.g., get_value([]) will return the
     factor's single value. Constraint factors might be created when a
-    factor is restricted.'''
+    factor is restricted.
+
+    Internally the table is one contiguous numpy array with an axis per
+    scope variable, so the VE routines can operate on it with whole-array
+    numpy calls.'''
+
+    __slots__ = ('name', 'scope', 'values')
 
     def __init__(self, name, scope):
         '''create a Factor object, specify the Factor name (a string)
         and its scope (an ORDERED list of variable objects).'''
-        self.scope = list(scope)
+        self.scope = tuple(scope)
         self.name = name
-        size = 1
-        for v in scope:
-            size = size * v.domain_size()
-        self.values = [0] * size  # initialize values to be long list of zeros.
+        # Store the table as a dense numpy tensor with one axis per scope
+        # variable. Axis k is indexed by the value indices of scope[k], so
+        # looking up an assignment is a single tuple index instead of a
+        # running flat-index computation.
+        shape = tuple(v.domain_size() for v in scope)
+        self.values = np.zeros(shape, dtype=factor_dtype())
 
     def get_scope(self):
-        '''returns copy of scope...you can modify this copy without affecting
-           the factor object'''
-        return list(self.scope)
+        '''returns the scope as a read-only tuple; call list() on it if you
+           need a mutable copy'''
+        return self.scope
 
     def add_values(self, values):
         '''This routine can be used to initialize the factor. We pass
@@ -178,12 +204,18 @@ class Factor:
          This list initializes the factor so that, e.g., its value on
          (A=2,B=b,C='light) is 2.25'''
 
-        for t in values:
-            index = 0
-            for v in self.scope:
-                index = index * v.domain_size() + v.value_index(t[0])
-                t = t[1:]
-            self.values[index] = t[0]
+        if not self.scope:
+            for t in values:
+                self.values[()] = t[-1]
+            return
+
+        arr = np.asarray(values, dtype=object)
+        vals = arr[:, -1].astype(self.values.dtype)
+        # translate each value column to integer indices, then scatter every
+        # row into the table with one fancy-indexed assignment
+        cols = tuple(np.array([v.value_index(x) for x in arr[:, j]])
+                     for j, v in enumerate(self.scope))
+        self.values[cols] = vals
 
     def add_value_at_current_assignment(self, number):
 
@@ -215,18 +247,21 @@ class Factor:
         the values must be given in the same order as the variables in the factor's
         scope.
 
-        See recursive_print_values called by print_table to see an example of
-        where the current_assignment interface to the factor values comes in handy.
         '''
 
-        index = 0
-        for v in self.scope:
-            index = index * v.domain_size() + v.get_assignment_index()
+        index = tuple(v.get_assignment_index() for v in self.scope)
         self.values[index] = number
 
     def get_values(self):
         return self.values
 
+    def lookup(self, index):
+        '''Return the table value at a tuple of integer value indices, one
+        per scope variable. Unlike get_value_at_current_assignments this
+        reads no Variable state, so it is safe to call from code that must
+        not depend on (or race with) the shared assignment markers.'''
+        return self.values[tuple(index)]
+
     def get_value(self, variable_values):
 
         '''This function is used to retrieve a value from the
@@ -239,10 +274,11 @@ class Factor:
         equal to the value of this factor on the assignment (A=1,
         B='b', C='light')'''
 
-        index = 0
-        for v in self.scope:
-            index = index * v.domain_size() + v.value_index(variable_values[0])
-            variable_values = variable_values[1:]
+        if len(variable_values) != len(self.scope):
+            raise ValueError(
+                "Factor {} takes {} values, got {}".format(
+                    self.name, len(self.scope), len(variable_values)))
+        index = tuple(v.value_index(val) for v, val in zip(self.scope, variable_values))
         return self.values[index]
 
     def get_value_at_current_assignments(self):
@@ -258,33 +294,18 @@ class Factor:
         B.set_assignment('a') and C.set_assignment('heavy'), then this
         function would return the value of the factor on the
         assigments (A=1, B='1', C='heavy')'''
-        index = 0
-        for v in self.scope:
-            index = index * v.domain_size() + v.get_assignment_index()
+        index = tuple(v.get_assignment_index() for v in self.scope)
         return self.values[index]
 
     def print_table(self):
         '''print the factor's table'''
-        saved_values = []  # save and then restore the variable assigned values.
-        for v in self.scope:
-            saved_values.append(v.get_assignment_index())
-
-        self.recursive_print_values(self.scope)
-
-        for v in self.scope:
-            v.set_assignment_index(saved_values[0])
-            saved_values = saved_values[1:]
-
-    def recursive_print_values(self, vars):
-        if len(vars) == 0:
-            print("[", end=""),
-            for v in self.scope:
-                print("{} = {},".format(v.name, v.get_assignment()), end="")
-            print("] = {}".format(self.get_value_at_current_assignments()))
-        else:
-            for val in vars[0].domain():
-                vars[0].set_assignment(val)
-                self.recursive_print_values(vars[1:])
+        # iterate the index space directly; no variable assignments are
+        # touched, so there is no state to save and restore
+        for idx in itertools.product(*(range(v.domain_size()) for v in self.scope)):
+            print("[", end="")
+            for v, i in zip(self.scope, idx):
+                print("{} = {},".format(v.name, v.dom[i]), end="")
+            print("] = {}".format(self.values[idx]))
 
     def __repr__(self):
         return ("{}".format(self.name))
@@ -299,33 +320,91 @@ class BN:
         self.name = name
         self.Variables = list(Vars)
         self.Factors = list(Factors)
+        # shared immutable copies handed out by variables()/factors()
+        self._vars_tuple = tuple(self.Variables)
+        self._factors_tuple = tuple(self.Factors)
+        self._by_name = {v.name: v for v in self.Variables}
+        var_ids = set(map(id, self.Variables))
         for f in self.Factors:
             for v in f.get_scope():
-                if not v in self.Variables:
-                    print("Bayes net initialization error")
-                    print("Factor scope {} has variable {} that", end='')
-                    print(" does not appear in list of variables {}.".format(list(map(lambda x: x.name, f.get_scope())),
-                                                                         v.name, list(map(lambda x: x.name, Vars))))
+                if id(v) not in var_ids:
+                    raise ValueError(
+                        "Bayes net initialization error: factor scope {} has"
+                        " variable {} that does not appear in list of"
+                        " variables {}.".format(
+                            list(map(lambda x: x.name, f.get_scope())), v.name,
+                            list(map(lambda x: x.name, Vars))))
+
+        # factors grouped by scope size, for callers that only care about
+        # e.g. the priors or the two-variable conditionals
+        self._factors_by_arity = {}
+        for f in self.Factors:
+            self._factors_by_arity.setdefault(len(f.get_scope()), []).append(f)
+
+        # every CPT factor has scope [child, parent1, ..., parentk]; cache
+        # the implied parent map and a topological order once so inference
+        # routines don't recompute them per query
+        self._parents_of = {}
+        for f in self.Factors:
+            scope = f.get_scope()
+            if scope and scope[0].name not in self._parents_of:
+                self._parents_of[scope[0].name] = list(scope[1:])
+
+        self._topo_order = []
+        placed = set()
+        while len(self._topo_order) < len(self.Variables):
+            progressed = False
+            for v in self.Variables:
+                if v.name in placed:
+                    continue
+                if all(p.name in placed for p in self._parents_of.get(v.name, [])):
+                    self._topo_order.append(v)
+                    placed.add(v.name)
+                    progressed = True
+            if not progressed:
+                raise ValueError(
+                    "Bayes net initialization error: factor scopes do not"
+                    " define an acyclic child-first CPT structure;"
+                    " variables {} cannot be ordered.".format(
+                        [v.name for v in self.Variables
+                         if v.name not in placed]))
+        self._topo_order = tuple(self._topo_order)
+
+    def topological_order(self):
+        '''return the variables ordered so every parent precedes its children
+           (a read-only tuple)'''
+        return self._topo_order
+
+    def parents(self, var):
+        '''return the parents of var in the DAG implied by the CPT factors'''
+        return list(self._parents_of.get(var.name, []))
 
     def factors(self):
-        return list(self.Factors)
+        '''return the net's factors (a read-only tuple; call list() on it
+           if you need a mutable copy)'''
+        return self._factors_tuple
+
+    def factors_by_arity(self, arity):
+        '''return the factors whose scope contains exactly arity variables'''
+        return list(self._factors_by_arity.get(arity, []))
 
     def variables(self):
-        return list(self.Variables)
+        '''return the net's variables (a read-only tuple)'''
+        return self._vars_tuple
 
     def get_variable(self, name):
-        for v in list(self.Variables):
-            if v.name == name:
-                return v
-        return None
+        return self._by_name.get(name)
 
     def reset_variables(self):
         for v in list(self.Variables):
-            v.evidence_index = -1
-            v.assignment_index = -1
+            v.reset_evidence()
+            v.reset_assignment()
 
 
+@lru_cache(maxsize=1)
 def adultDatasetBN():
+    # cached: repeated calls return the same BN object; call
+    # reset_variables() on it if a previous query left evidence set
 
     ms = Variable("MaritalStatus", ['Not-Married', 'Married', 'Separated', 'Widowed'])
     F0 = Factor("P(ms)", [ms])
@@ -378,7 +457,10 @@ def adultDatasetBN():
 
     return adultDataset
 
+@lru_cache(maxsize=1)
 def adultDatasetBN2():
+    # cached: repeated calls return the same BN object; call
+    # reset_variables() on it if a previous query left evidence set
 
     ms = Variable("MaritalStatus", ['Not-Married', 'Married', 'Separated', 'Widowed'])
     F0 = Factor("P(ms)", [ms])
@@ -428,56 +510,29 @@ def restrict_factor(f, var, value):
     If f has only one variable its restriction yields a
     constant factor'''
 
-    scope = f.get_scope()
+    scope = list(f.get_scope())
+    axis = scope.index(var)
     scope.remove(var)
     F = Factor("Restrict {}|{}={}".format(f.name, var.name, value), scope)
-    var.set_assignment(value)
-
-    def recursive_restrict_factor(Vars):
-        if len(Vars) == 0:
-            F.add_value_at_current_assignment(f.get_value_at_current_assignments())
-        elif Vars[0] != var:
-            for val in Vars[0].domain():
-                Vars[0].set_assignment(val)
-                recursive_restrict_factor(Vars[1:])
-        else:
-            recursive_restrict_factor(Vars[1:])
-
-    recursive_restrict_factor(f.get_scope())
+    # selecting var = value is just a slice along its axis of the table
+    F.values = np.take(f.values, var.value_index(value), axis=axis)
     return F
 
 def sum_out_variable(f, var):
     '''Returns a new factor that is the product of the factors in Factors
        followed by the summing out of Var'''
-    scope = f.get_scope()
+    scope = list(f.get_scope())
+    axis = scope.index(var)
     scope.remove(var)
     F = Factor("Eliminate-{}-{}".format(var.name, f), scope)
-
-    def recursive_eliminate_variable(Vars):
-        if len(Vars) == 0:
-            summ = 0
-            for val in var.domain():
-                var.set_assignment(val)
-                prod = f.get_value_at_current_assignments()
-                summ = summ + prod
-            F.add_value_at_current_assignment(summ)
-        else:
-            for val in Vars[0].domain():
-                Vars[0].set_assignment(val)
-                recursive_eliminate_variable(Vars[1:])
-
-    recursive_eliminate_variable(scope)
+    # summing out a variable is a reduction over its axis of the table
+    F.values = f.values.sum(axis=axis)
     return F
 
 def normalize(nums):
-    '''Takes as input a list of number and return a new list of numbers where
-    now the numbers sum to 1, i.e., normalize the input numbers'''
-    s = sum(nums)
-    if s == 0:
-        newnums = [0] * len(nums)
-    else:
-        newnums = []
-        for n in nums:
-            newnums.append(n / s)
-    return newnums
+    '''Takes as input a list (or array) of numbers and returns an ndarray
+    of numbers that sum to 1, i.e., normalize the input numbers'''
+    arr = np.asarray(nums, dtype=np.float64)
+    s = arr.sum()
+    return arr / s if s > 0 else np.zeros_like(arr)
 
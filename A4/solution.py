@@ -1,64 +1,91 @@
-import random  # for sampling methods
 import numpy as np
 import pandas as pd  # to simplify reading and holding data
-from bnetbase import Variable, Factor, BN, restrict_factor, sum_out_variable, normalize
-from itertools import product
-import itertools
+from bnetbase import Variable, Factor, BN, restrict_factor, normalize, factor_dtype
+from functools import lru_cache
 
+# subscript letters handed out to variables when building einsum expressions
+_EINSUM_LETTERS = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
 
-def multiply_factors(Factors):
-    '''return a new factor that is the product of the factors in Factors'''
-    factors = Factors.copy()
-    while True:
-        if len(factors) == 1:
-            break
-        factor1 = factors.pop()
-        factor2 = factors.pop()
-
-        scope1 = factor1.get_scope()
-        scope2 = factor2.get_scope()
 
-        remaining_scope1 = [var for var in scope1 if var not in scope2]
+def _einsum_letters(Factors):
+    """Assign one einsum subscript letter to every variable in Factors."""
+    letters = {}
+    for f in Factors:
+        for v in f.get_scope():
+            if v not in letters:
+                letters[v] = _EINSUM_LETTERS[len(letters)]
+    return letters
 
-        # filtering the similar ones from 1
-        new_scp = scope2 + remaining_scope1
 
-        factor = Factor("Factor", new_scp)
-
-        combs = list(itertools.product(*[scp.domain() for scp in new_scp]))
+def multiply_factors(Factors):
+    '''return a new factor that is the product of the factors in Factors'''
+    if len(Factors) == 1:
+        return Factors[0]
 
-        for comb in combs:
-            comb1, comb2 = [], []
-            for elem in scope1:
-                comb1.append(comb[new_scp.index(elem)])
+    letters = _einsum_letters(Factors)
 
-            for elem in scope2:
-                comb2.append(comb[new_scp.index(elem)])
+    # canonical scope order: the union of the scopes sorted by variable
+    # name, so callers can predict the axis order of the product
+    new_scp = sorted(letters, key=lambda v: v.name)
+    subs = ','.join(''.join(letters[v] for v in f.get_scope()) for f in Factors)
+    out = ''.join(letters[v] for v in new_scp)
 
-            mult = factor1.get_value(comb1) * factor2.get_value(comb2)
-            # Multiply the values and add to the new factor
-            factor.add_values([list(comb) + [mult]])
-        factors.append(factor)
-    return factors[0]
+    # the whole product is one einsum contraction; 'greedy' lets numpy
+    # pick a cheap pairwise order
+    factor = Factor("Factor", new_scp)
+    factor.values = np.einsum('{}->{}'.format(subs, out),
+                              *[f.values for f in Factors], optimize='greedy')
+    return factor
 
 
 ###Orderings
-def min_fill_ordering(Factors, QueryVar):
+def min_fill_ordering(Factors, KeepVars):
     """
-    Ordering
-    Do this
+    Order the elimination variables with the min-fill heuristic.
+
+    KeepVars is a Variable, or a list of Variables, that must stay out of
+    the ordering (the query and any evidence kept as table axes). Each
+    factor scope forms a clique in the interaction graph. At every step
+    we eliminate the variable whose elimination adds the fewest fill
+    edges (pairs of its neighbours not already adjacent), then connect
+    those neighbours — the graph change that creating the eliminated
+    factor would cause.
     """
-    count_dct = {}
+    if isinstance(KeepVars, Variable):
+        KeepVars = [KeepVars]
+    keep = set(KeepVars)
+
+    adj = {}
     for factor in Factors:
-        scopes = factor.get_scope()
-        for scope in scopes:
-            if scope != QueryVar:
-                count_dct.setdefault(scope, 0)
-                count_dct[scope] += 1
-    ordered_list = []
-    for var, _ in sorted(count_dct.items(), key=lambda x: x[1]):
-        ordered_list.append(var)
-    return ordered_list
+        scope = factor.get_scope()
+        for v in scope:
+            adj.setdefault(v, set())
+            for u in scope:
+                if u is not v:
+                    adj[v].add(u)
+    for v in keep:
+        adj.pop(v, None)
+    for neighbours in adj.values():
+        neighbours.difference_update(keep)
+
+    def fill_edges(v):
+        neighbours = list(adj[v])
+        return sum(1 for i, u in enumerate(neighbours)
+                   for w in neighbours[i + 1:] if w not in adj[u])
+
+    order = []
+    while adj:
+        var = min(adj, key=fill_edges)
+        neighbours = adj.pop(var)
+        for u in neighbours:
+            adj[u].discard(var)
+            adj[u].update(n for n in neighbours if n is not u)
+        order.append(var)
+    return order
+
+
+# results of previous VE calls, keyed by net, query and evidence setting
+_ve_cache = {}
 
 
 def VE(Net, QueryVar, EvidenceVars):
@@ -80,17 +107,33 @@ def VE(Net, QueryVar, EvidenceVars):
    list of three numbers. E.g. [0.5, 0.24, 0.26]. These numbers would
    mean that Pr(A='a'|B=1, C='c') = 0.5 Pr(A='a'|B=1, C='c') = 0.24
    Pr(A='a'|B=1, C='c') = 0.26
+
+   EvidenceVars may also be a dict mapping Variable objects to observed
+   values; this form does not rely on set_evidence having been called.
     '''
 
-    probabilities = []
-    factors = Net.factors()
+    if isinstance(EvidenceVars, dict):
+        evidence = list(EvidenceVars.items())
+    else:
+        evidence = [(v, v.get_evidence()) for v in EvidenceVars]
+    # canonical order so equivalent evidence settings share a cache entry
+    evidence.sort(key=lambda pair: pair[0].name)
 
-    for ev in EvidenceVars:
+    key = (id(Net), QueryVar.name,
+           tuple((v.name, val) for v, val in evidence))
+    if key in _ve_cache:
+        return _ve_cache[key].copy()
+
+    # Net.factors() is a shared tuple; the restriction loop below
+    # replaces entries in place, so take a mutable copy
+    factors = list(Net.factors())
+
+    for ev, val in evidence:
         i = 0
         while i < len(factors):
             factor = factors[i]
             if ev in factor.get_scope():
-                factors[i] = restrict_factor(factor, ev, ev.get_evidence())
+                factors[i] = restrict_factor(factor, ev, val)
             i += 1
 
     ordered = min_fill_ordering(factors, QueryVar)
@@ -100,22 +143,60 @@ def VE(Net, QueryVar, EvidenceVars):
         factors = VE_helper(factors, var)
     last_factor = multiply_factors(factors)
 
-    for dom in QueryVar.domain():
-        prob = last_factor.get_value([dom])
-        probabilities.append(prob)
-    return normalize(probabilities)
+    # only QueryVar is left, so the factor table is the unnormalized
+    # distribution in domain order
+    result = normalize(last_factor.values)
+    _ve_cache[key] = result
+    return result.copy()
+
+
+VE.clear_cache = _ve_cache.clear
+
+
+def VE_batch(Net, QueryVar, EvidenceVars):
+    '''
+    Compute the conditional distribution of QueryVar for EVERY setting of
+    the evidence variables in one elimination pass.
+
+    Returns an ndarray of shape (|QueryVar|, |ev1|, ..., |evk|) normalized
+    along the query axis, so entry [:, i1, ..., ik] is the distribution
+    VE would return with the evidence set to the i'th domain values. One
+    batched call replaces a separate VE run per evidence assignment.
+    '''
+    factors = Net.factors()
+    keep = [QueryVar] + list(EvidenceVars)
+
+    for var in min_fill_ordering(factors, keep):
+        factors = VE_helper(factors, var)
+    last_factor = multiply_factors(factors)
+
+    # put the query axis first and the evidence axes in the given order
+    scope = last_factor.get_scope()
+    table = np.transpose(last_factor.values, [scope.index(v) for v in keep])
+
+    totals = table.sum(axis=0, keepdims=True)
+    return np.divide(table, totals, out=np.zeros_like(table), where=totals > 0)
 
 
 def VE_helper(factors, var):
     """
-    Helper for VE that eliminates the vars
+    Helper for VE that eliminates var: one einsum contracts the relevant
+    factors and sums out var in the same pass, so the full product is
+    never materialized.
     """
     lst = [factor for factor in factors if var in factor.get_scope()]
     if not lst:
         return factors
-    multiplied_factor = multiply_factors(lst)
     new_lst = [factor for factor in factors if factor not in lst]
-    summed = sum_out_variable(multiplied_factor, var)
+
+    letters = _einsum_letters(lst)
+    new_scp = sorted((v for v in letters if v is not var), key=lambda v: v.name)
+    subs = ','.join(''.join(letters[v] for v in f.get_scope()) for f in lst)
+    out = ''.join(letters[v] for v in new_scp)
+
+    summed = Factor("Factor", new_scp)
+    summed.values = np.einsum('{}->{}'.format(subs, out),
+                              *[f.values for f in lst], optimize='greedy')
     new_lst.append(summed)
     return new_lst
 
@@ -140,79 +221,72 @@ def SampleBN(Net, QueryVar, EvidenceVars):
     values of these samples.
     '''
 
-    # YOUR CODE HERE
-    weights = [0] * len(QueryVar.domain())
-    total = 0
-    evidence = EvidenceVars.copy()
-
-    for i in range(1000):
-        curr_weight = 1
-        dct = {}
-
-        # For each singular factor we have to modify the curr weight
-        for ev in evidence:
-            dct[ev.name] = ev.get_evidence()
-            for factor in Net.factors():
-                scp = factor.get_scope()
-                if ev in scp and len(scp) == 1:
-                    curr_weight *= factor.get_value([ev.get_evidence()])
-
-        for variable in Net.variables():
-            if variable not in EvidenceVars:
-                for factor in Net.factors():
-                    if variable in factor.get_scope():
-                        curr_factor = factor
-                        break
-
-                if curr_factor is not None:
-                    probs = []
-                    for val in variable.domain():
-                        combination = []
-                        for v in curr_factor.get_scope():
-                            if v == variable:
-                                combination.append(val)
-                            else:
-                                combination.append(dct[v.name])
-
-                        # Formed combinations like [Age, Country] so we can get the prob
-                        probability = curr_factor.get_value(combination)
-                        probs.append(probability)
-
-
-                    # trying to normalize probs
-                    prob_sum = sum(probs)
-                    normalized_probs = []
-                    for p in probs:
-                        normalized_probs.append(p / prob_sum)
-
-                    # choose a value
-                    accumulator = 0
-                    chosen_val = 0
-                    random_num = random.random()
-                    for i in range(len(normalized_probs)):
-                        accumulator += normalized_probs[i]
-                        if random_num <= accumulator:
-                            chosen_val = variable.domain()[i]
-                            break
-
-                    dct[variable.name] = chosen_val
-
-        query = dct.get(QueryVar.name, None)
-        if query:
-            for _, value in enumerate(QueryVar.domain()):
-                if value == query:
-                    weights[i] += curr_weight
-                    break
-        total += curr_weight
-
-    probabilities = []
-    for weight in weights:
-        normalized_weight = weight / total
-        probabilities.append(normalized_weight)
-
-    return probabilities
-
-
+    n = 1000
+    evidence = {ev: ev.get_evidence() for ev in EvidenceVars}
+
+    # each CPT factor has scope [child, parent1, ..., parentk]
+    cpt_of = {}
+    for factor in Net.factors():
+        scp = factor.get_scope()
+        if scp and scp[0] not in cpt_of:
+            cpt_of[scp[0]] = factor
+
+    # sample all n particles at once, one variable at a time in topological
+    # order; samples holds value indices of shape (n,) per variable
+    samples = {}
+    weights = np.ones(n)
+
+    for variable in Net.topological_order():
+        factor = cpt_of[variable]
+        parents = factor.get_scope()[1:]
+        table = factor.values
+
+        if parents:
+            # columns of the CPT selected by the sampled parent values,
+            # shape (domain size, n)
+            cols = table[(slice(None),) + tuple(samples[p] for p in parents)]
+        else:
+            cols = table[:, None]
+
+        if variable in evidence:
+            idx = variable.value_index(evidence[variable])
+            weights = weights * cols[idx]
+            samples[variable] = np.full(n, idx, dtype=np.int64)
+        else:
+            # Gumbel-max: argmax(log p + g) with g ~ Gumbel(0, 1) draws
+            # from the categorical without normalizing or building a CDF.
+            # Noise is always (domain size, n): for a root variable cols
+            # has one column shared by all particles and must not shrink
+            # the draw to a single sample
+            g = -np.log(-np.log(np.random.random((cols.shape[0], n))))
+            # dtype-aware floor keeps log() finite on zero entries even
+            # for float32 tables (USE_FP32), where 1e-300 underflows to 0
+            tiny = np.finfo(cols.dtype).tiny
+            samples[variable] = np.argmax(np.log(cols + tiny) + g, axis=0)
+
+    counts = np.bincount(samples[QueryVar], weights=weights,
+                         minlength=QueryVar.domain_size())
+    return normalize(counts)
+
+
+@lru_cache(maxsize=1)
+def _covid_data():
+    """Read the COVID dataset once; both causal models reuse the frame."""
+    return pd.read_csv('data/covid.csv')
+
+
+def _joint_counts(df, columns, domains):
+    """Dense count tensor over the given columns, one axis per column in
+    the order given, with axis positions matching the domain lists."""
+    codes = [pd.Categorical(df[col], categories=dom).codes
+             for col, dom in zip(columns, domains)]
+    shape = tuple(len(dom) for dom in domains)
+    flat = np.ravel_multi_index(codes, shape)
+    counts = np.bincount(flat, minlength=int(np.prod(shape)))
+    return counts.reshape(shape).astype(factor_dtype())
+
+
+@lru_cache(maxsize=1)
 def CausalModelMediator():
     """CausalModelConfounder returns a Causal model (i.e. a BN) that
     represents the joint distribution of value assignments to
@@ -227,7 +301,7 @@ def CausalModelMediator():
      """
 
     ### READ IN THE DATA
-    df = pd.read_csv('data/covid.csv')
+    df = _covid_data()
 
     ### DOMAIN INFORMATION
     variable_domains = {
@@ -245,29 +319,20 @@ def CausalModelMediator():
     factor_age = Factor("A|C", [Age, Country])
     factor_fatality = Factor("F|A,C", [Fatality, Age, Country])
 
-    # entering factors
-    country_populations = df['Country'].value_counts()
-    for country_name, population in country_populations.items():
-        if country_name in Country.domain():
-            probability = population / len(df)
-            factor_country.add_values([[country_name, probability]])
-
-    # entering factor age
-    age_country_counts = df.groupby(['Country', 'Age']).size()
-    for elem in age_country_counts.items():
-        country_data, population = elem[0], elem[1]
-        name, age = country_data[0], country_data[1]
-        country_count = country_populations.get(name, 0)
-        factor_age.add_values([[age, name, population / country_count if country_count > 0 else 0]])
-
-    fatality_age_country_counts = df.groupby(['Fatality', 'Age', 'Country']).size()
-    for elem in fatality_age_country_counts.items():
-        country_data = elem[0]
-        fatality, age, name = country_data[0], country_data[1], country_data[2]
-        population = elem[1]
-        count = fatality_age_country_counts.get((fatality, age, name), 0)
-        probability = population / count if count > 0 else 0
-        factor_fatality.add_values([[fatality, age, name, probability]])
+    # one pass over the data gives every table: count the (F, A, C)
+    # triples, then conditionals are marginalizations plus one division
+    counts = _joint_counts(df, ['Fatality', 'Age', 'Country'],
+                           [Fatality.domain(), Age.domain(), Country.domain()])
+    age_country = counts.sum(axis=0)
+    country_counts = age_country.sum(axis=0)
+
+    factor_country.values = country_counts / len(df)
+    factor_age.values = np.divide(age_country, country_counts,
+                                  out=np.zeros_like(age_country),
+                                  where=country_counts > 0)
+    factor_fatality.values = np.divide(counts, age_country,
+                                       out=np.zeros_like(counts),
+                                       where=age_country > 0)
 
     # creating BN
     bn = BN('CausalModelMediator', [Country, Age, Fatality], [factor_country, factor_age, factor_fatality])
@@ -275,6 +340,7 @@ def CausalModelMediator():
     return bn
 
 
+@lru_cache(maxsize=1)
 def CausalModelConfounder():
     """CausalModelConfounder returns a Causal model (i.e. a BN) that
    represents the joint distribution of value assignments to
@@ -289,7 +355,7 @@ def CausalModelConfounder():
     """
 
     ### READ IN THE DATA
-    df = pd.read_csv('data/covid.csv')
+    df = _covid_data()
 
     ### DOMAIN INFORMATION
     variable_domains = {
@@ -313,21 +379,19 @@ def CausalModelConfounder():
     factor_country_age = Factor("P(C|A)", [Country, Age])
     factor_fatality_age_country = Factor("P(F|A,C)", [Fatality, Age, Country])
 
-    for country in Country.domain():
-        for age in Age.domain():
-            country_df = df['Country'] == country
-            age_df = df['Age'] == age
-            comb = df[country_df & age_df]
-            temp_prob = len(comb) / len(df[age_df])
-            factor_country_age.add_values([[country, age, temp_prob]])
-
-            for fatality in Fatality.domain():
-                country_df = df['Country'] == country
-                age_df = df['Age'] == age
-                fatality_df = df['Fatality'] == fatality
-                comb = df[country_df & age_df & fatality_df]
-                temp_prob = len(comb) / len(df[country_df & age_df])
-                factor_fatality_age_country.add_values([[fatality, age, country, temp_prob]])
+    # same single counting pass as the mediator, marginalized differently
+    counts = _joint_counts(df, ['Fatality', 'Age', 'Country'],
+                           [Fatality.domain(), Age.domain(), Country.domain()])
+    age_country = counts.sum(axis=0)
+    age_counts = age_country.sum(axis=1)
+
+    factor_age.values = age_counts / len(df)
+    factor_country_age.values = np.divide(age_country.T, age_counts,
+                                          out=np.zeros_like(age_country.T),
+                                          where=age_counts > 0)
+    factor_fatality_age_country.values = np.divide(counts, age_country,
+                                                   out=np.zeros_like(counts),
+                                                   where=age_country > 0)
     # create the bn
     bn = BN('CausalModelConfounder', [Age, Country, Fatality], [factor_age, factor_country_age, factor_fatality_age_country])
 
@@ -354,19 +418,21 @@ if __name__ == "__main__":
 
     # CONFOUNDER
     confounder_bn = CausalModelConfounder()
-    ace_confounding = 0
-    for age in age_new.domain():
-        age_new.set_evidence(age)
-
-        country.set_evidence("Italy")
-        italy_data = VE(confounder_bn, fatality, [country, age_new])
-
-        country.set_evidence("China")
-        china_data = VE(confounder_bn, fatality, [country, age_new])
-
-        ace_confounding = (italy_data[1] - china_data[1])
-
-
+    # the confounder net has its own Variable objects; querying it with
+    # the mediator's variables would eliminate everything
+    country = confounder_bn.get_variable("Country")
+    fatality = confounder_bn.get_variable("Fatality")
+
+    # adjustment formula, sum_a P(a) [P(F=NO|a,Italy) - P(F=NO|a,China)],
+    # straight off the CPT tables: no VE calls per age bucket, and no
+    # chance of overwriting the accumulator as the old loop did
+    factor_age = confounder_bn.factors_by_arity(1)[0]
+    factor_fatality = confounder_bn.factors_by_arity(3)[0]
+
+    fatal_no = factor_fatality.values[fatality.value_index("NO")]
+    diff = (fatal_no[:, country.value_index("Italy")]
+            - fatal_no[:, country.value_index("China")])
+    ace_confounding = float(np.dot(factor_age.values, diff))
 
     print("age: Confounder: ", ace_confounding)
 